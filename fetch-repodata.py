@@ -1,22 +1,34 @@
 #! /usr/bin/env python
 
-from argparse import Action, ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from argparse import (
+    Action,
+    ArgumentDefaultsHelpFormatter,
+    ArgumentParser,
+    ArgumentTypeError,
+    Namespace,
+)
 from copy import copy
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime
-from json import dump as json_dump, loads as json_loads
+from json import dump as json_dump
 from logging import getLogger, StreamHandler
-from re import sub as re_sub
+from multiprocessing import get_context
+from pathlib import Path
+from shutil import copyfileobj
+from socket import SO_KEEPALIVE, SOL_SOCKET
 from typing import Any, Collection, Dict, List, Optional, Tuple
 from urllib.parse import quote as urllib_quote
 import os
 
 from ntplib import NTPClient, NTPException  # type: ignore
-from requests import Session
+import orjson
+from requests import Response, Session
 from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 from urllib3 import Retry  # type: ignore
+from urllib3.connection import HTTPConnection  # type: ignore
+from zstandard import ZstdDecompressor  # type: ignore
 
 
 logger = getLogger(__name__)
@@ -39,6 +51,14 @@ _DEFAULT_SUBDIRS = (
     "win-64",
 )
 
+# HTTP cache validators are kept next to each repodata.json in a repodata.json.cache file,
+# together with the output settings used to write it.
+# Key in that file, response header and request header of each validator:
+_CACHE_VALIDATORS = (
+    ("etag", "ETag", "If-None-Match"),
+    ("last_modified", "Last-Modified", "If-Modified-Since"),
+)
+
 
 @dataclass
 class OutputConfig:
@@ -59,6 +79,9 @@ class OutputConfig:
         "type",
     )
 
+    def __post_init__(self) -> None:
+        self.trim_keys = frozenset(self.trim_keys)
+
 
 class FetchError(Exception):
     pass
@@ -72,9 +95,28 @@ def get_ntp_time() -> str:
         "3.pool.ntp.org",
     )
     client = NTPClient()
+    # Race all servers first and only wait for each one in turn if none answered quickly.
+    # The retries share what is left of the former bound of 2 s per server.
+    race_timeout = 1.0
+    retry_timeout = (2 * len(ntp_pool) - race_timeout) / len(ntp_pool)
+    executor = ThreadPoolExecutor(max_workers=len(ntp_pool))
+    try:
+        futures = [
+            executor.submit(client.request, server, version=4, timeout=race_timeout)
+            for server in ntp_pool
+        ]
+        for future in as_completed(futures):
+            try:
+                response = future.result()
+            except NTPException:
+                continue
+            time = datetime.fromtimestamp(response.tx_time)
+            return time.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
     for server in ntp_pool:
         try:
-            response = client.request(server, version=4, timeout=2)
+            response = client.request(server, version=4, timeout=retry_timeout)
         except NTPException:
             continue
         time = datetime.fromtimestamp(response.tx_time)
@@ -97,31 +139,160 @@ class AppendDefaultAction(Action):
         setattr(namespace, self.dest, items)
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"{value} is not a positive integer.")
+    return number
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(
+        self, connections: int, maxsize: int, block: bool = False, **pool_kwargs: Any
+    ) -> None:
+        # Keep urllib3's defaults (TCP_NODELAY) and let idle pooled connections be kept alive.
+        pool_kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (SOL_SOCKET, SO_KEEPALIVE, 1),
+        ]
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+
 def cleanup_unneeded_info(
     repodata: Dict[str, Any],
     trim_keys: Collection[str],
-) -> Dict[str, Any]:
+) -> None:
     if not trim_keys:
-        return repodata
-    output_repodata = repodata.copy()
-    for packages_key in ["packages", "packages.conda"]:
-        if packages_key in repodata:
-            output_repodata[packages_key] = {
-                filename: {key: value for key, value in package.items() if key not in trim_keys}
-                for filename, package in repodata[packages_key].items()
-            }
-    return output_repodata
+        return
+    for packages_key in ("packages", "packages.conda"):
+        packages = repodata.get(packages_key)
+        if not packages:
+            continue
+        for package in packages.values():
+            for key in trim_keys:
+                package.pop(key, None)
+
+
+def dump_repodata(
+    repodata: Dict[str, Any], output_file_path: str, output_config: OutputConfig
+) -> None:
+    if output_config.indent == 2:
+        # orjson only has a fixed 2-space layout, so output_config.separators is not applied,
+        # and it writes non-ASCII characters as UTF-8 instead of \uXXXX escapes.
+        # Its OPT_SORT_KEYS is also cheaper than pre-sorting the dicts in Python.
+        with open(output_file_path, "wb") as output_file:
+            output_file.write(
+                orjson.dumps(repodata, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+            )
+        return
+    with open(output_file_path, "w") as output_file:
+        json_dump(
+            repodata,
+            output_file,
+            sort_keys=True,
+            indent=output_config.indent,
+            separators=output_config.separators,
+        )
+
+
+def get_output_fingerprint(output_config: OutputConfig) -> Dict[str, Any]:
+    return {
+        "trim_keys": sorted(output_config.trim_keys),
+        "indent": output_config.indent,
+        "separators": list(output_config.separators),
+    }
+
+
+def read_cache_headers(output_file_path: str, output_config: OutputConfig) -> Dict[str, str]:
+    cache_path = Path(output_file_path + ".cache")
+    if not (os.path.exists(output_file_path) and cache_path.exists()):
+        return {}
+    try:
+        cache = orjson.loads(cache_path.read_bytes())
+    except orjson.JSONDecodeError:
+        return {}
+    # A file written with other output settings must be fetched and rewritten even if unchanged.
+    if cache.get("output") != get_output_fingerprint(output_config):
+        return {}
+    return {
+        request_header: cache[key]
+        for key, _, request_header in _CACHE_VALIDATORS
+        if cache.get(key)
+    }
+
+
+def clear_cache_validators(output_file_path: str) -> None:
+    Path(output_file_path + ".cache").unlink(missing_ok=True)
+
+
+def write_cache_validators(
+    output_file_path: str, output_config: OutputConfig, response: Response
+) -> None:
+    cache: Dict[str, Any] = {
+        key: response.headers[response_header]
+        for key, response_header, _ in _CACHE_VALIDATORS
+        if response.headers.get(response_header)
+    }
+    if not cache:
+        clear_cache_validators(output_file_path)
+        return
+    cache["output"] = get_output_fingerprint(output_config)
+    Path(output_file_path + ".cache").write_bytes(
+        orjson.dumps(cache, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2) + b"\n"
+    )
+
+
+def ends_with_json_object(file_path: str) -> bool:
+    with open(file_path, "rb") as input_file:
+        size = input_file.seek(0, os.SEEK_END)
+        input_file.seek(max(0, size - 64))
+        return input_file.read().rstrip().endswith(b"}")
+
+
+def write_repodata(
+    download_path: str, compressed: bool, output_file_path: str, output_config: OutputConfig
+) -> None:
+    content = Path(download_path).read_bytes()
+    if compressed:
+        content = ZstdDecompressor().decompressobj().decompress(content)
+    repodata = orjson.loads(content)
+    del content
+    cleanup_unneeded_info(repodata, output_config.trim_keys)
+    dump_repodata(repodata, output_file_path, output_config)
+
+
+def get_repodata_response(
+    session: Session, url: str, headers: Dict[str, str]
+) -> Tuple[Response, bool]:
+    # Prefer the zstd-compressed variant conda itself uses; not every channel provides it.
+    response = session.get(f"{url}.zst", headers=headers, stream=True)
+    compressed = response.status_code != 404
+    if not compressed:
+        response.close()
+        logger.debug(f"No {url}.zst found, falling back to {url} .")
+        response = session.get(url, headers=headers, stream=True)
+    try:
+        response.raise_for_status()
+    except HTTPError:
+        response.close()
+        raise
+    return response, compressed
 
 
 def fetch_repodata(
-    session: Session, timestamp: str, output_config: OutputConfig, channel: str, subdir: str
+    session: Session,
+    timestamp: str,
+    output_config: OutputConfig,
+    channel: str,
+    subdir: str,
+    output_file_path: str,
+    process_executor: Executor,
 ) -> Tuple[str, str, bool]:
-    url_prefix = f"{channel}/{subdir}"
-    url = f"{url_prefix}/repodata.json"
+    url = f"{channel}/{subdir}/repodata.json"
     logger.info(f"Fetching {url} ...")
     try:
-        response = session.get(url)
-        response.raise_for_status()
+        response, compressed = get_repodata_response(
+            session, url, read_cache_headers(output_file_path, output_config)
+        )
     except HTTPError as e:
         if e.response.status_code == 404:
             logger.warning(
@@ -129,30 +300,51 @@ def fetch_repodata(
             )
             return channel, subdir, False
         raise
-    else:
-        input_repodata = json_loads(response.text)
-        output_repodata = cleanup_unneeded_info(input_repodata, output_config.trim_keys)
-        output_subdir = re_sub("//", "%2F/", urllib_quote(url_prefix))
-        output_dir = output_config.output_root + "/" + output_subdir
-        os.makedirs(output_dir, exist_ok=True)
-        output_file_path = f"{output_dir}/repodata.json"
+    with response:
+        if response.status_code == 304:
+            logger.info(f"Not modified: {output_file_path}")
+            Path(output_file_path + ".time").write_text(timestamp + "\n")
+            return channel, subdir, True
         logger.info(f"Writing {output_file_path} ...")
-        with open(output_file_path + ".time", "w") as output_timestamp_file:
-            print(timestamp, file=output_timestamp_file)
-        with open(output_file_path, "w") as output_file:
-            json_dump(
-                output_repodata,
-                output_file,
-                sort_keys=True,
-                indent=output_config.indent,
-                separators=output_config.separators,
-            )
+        Path(output_file_path + ".time").write_text(timestamp + "\n")
+        # Do not let a partially written file be validated as up to date by the next run.
+        clear_cache_validators(output_file_path)
+        response.raw.decode_content = True
+        if not output_config.trim_keys:
+            # Nothing to trim, so store repodata.json as served without parsing it.
+            with open(output_file_path, "wb") as output_file:
+                if compressed:
+                    ZstdDecompressor().copy_stream(response.raw, output_file)
+                else:
+                    copyfileobj(response.raw, output_file)
+            # Catch truncated bodies or error pages that a full JSON parse would have rejected.
+            if not ends_with_json_object(output_file_path):
+                raise FetchError(f"Incomplete or invalid repodata.json from {response.url} .")
+            write_cache_validators(output_file_path, output_config, response)
+            return channel, subdir, True
+        # Pass the body to the worker process as a file, so it is neither held nor pickled here.
+        download_path = output_file_path + ".download"
+        with open(download_path, "wb") as download_file:
+            copyfileobj(response.raw, download_file)
+    # Waiting here keeps at most one body per thread in flight.
+    try:
+        process_executor.submit(
+            write_repodata, download_path, compressed, output_file_path, output_config
+        ).result()
+    finally:
+        Path(download_path).unlink(missing_ok=True)
+    write_cache_validators(output_file_path, output_config, response)
     return channel, subdir, True
 
 
 def fetch(
-    output_config: OutputConfig, channels: Tuple[str, ...], subdirs: Tuple[str, ...]
+    output_config: OutputConfig,
+    channels: Tuple[str, ...],
+    subdirs: Tuple[str, ...],
+    max_workers: Optional[int] = None,
 ) -> None:
+    if max_workers is None:
+        max_workers = min(32, len(channels) * len(subdirs))
     with Session() as session:
         session.headers["User-Agent"] += " https://github.com/bioconda/bioconda-repodata"
         retry_config = Retry(
@@ -161,17 +353,40 @@ def fetch(
             raise_on_status=True,
             raise_on_redirect=False,
         )
-        adapter = HTTPAdapter(max_retries=retry_config)
+        adapter = KeepAliveHTTPAdapter(
+            max_retries=retry_config,
+            pool_connections=len(channels),
+            pool_maxsize=len(channels) * len(subdirs),
+            pool_block=False,
+        )
         session.mount("http://", adapter)
         session.mount("https://", adapter)
         timestamp = get_ntp_time()
-        with ProcessPoolExecutor() as executor:
-            futures = []
+        output_file_paths: Dict[Tuple[str, str], str] = {}
+        for channel in channels:
             for subdir in subdirs:
-                for channel in channels:
+                output_subdir = urllib_quote(f"{channel}/{subdir}").replace("//", "%2F/")
+                output_dir = f"{output_config.output_root}/{output_subdir}"
+                os.makedirs(output_dir, exist_ok=True)
+                output_file_paths[channel, subdir] = f"{output_dir}/repodata.json"
+        # Parsing and writing is CPU-bound and runs in worker processes while threads download.
+        # Use "spawn" since forking a process that already runs threads is not safe.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, ProcessPoolExecutor(
+            mp_context=get_context("spawn")
+        ) as process_executor:
+            futures = []
+            for channel in channels:
+                for subdir in subdirs:
                     futures.append(
                         executor.submit(
-                            fetch_repodata, session, timestamp, output_config, channel, subdir
+                            fetch_repodata,
+                            session,
+                            timestamp,
+                            output_config,
+                            channel,
+                            subdir,
+                            output_file_paths[channel, subdir],
+                            process_executor,
                         ),
                     )
             unfetched_channels = set(channels)
@@ -190,7 +405,7 @@ def fetch(
 
 def parse_args(
     parser: ArgumentParser, argv: Optional[List[str]]
-) -> Tuple[str, OutputConfig, Tuple[str, ...], Tuple[str, ...]]:
+) -> Tuple[str, OutputConfig, Tuple[str, ...], Tuple[str, ...], Optional[int]]:
     args = parser.parse_args(argv)
 
     channels = tuple(map(str, args.channel))
@@ -200,12 +415,14 @@ def parse_args(
         output_root=args.output,
         indent=args.indent,
         separators=args.separators,
-        trim_keys=set(args.trim_keys) if args.trim else {},
+        trim_keys=frozenset(args.trim_keys) if args.trim else frozenset(),
     )
 
     log_level: str = args.log_level.upper()
 
-    return log_level, output_config, channels, subdirs
+    max_workers: Optional[int] = args.max_workers
+
+    return log_level, output_config, channels, subdirs, max_workers
 
 
 def get_argument_parser() -> ArgumentParser:
@@ -235,12 +452,19 @@ def get_argument_parser() -> ArgumentParser:
         "--indent",
         type=int,
         default=OutputConfig.indent,
-        help="Indentation of JSON output files.",
+        help=(
+            "Indentation of JSON output files. Indentation 2 uses the faster orjson encoder, "
+            "which writes non-ASCII characters as UTF-8 instead of \\uXXXX escapes. "
+            "Only used if --trim is provided, otherwise repodata.json is stored as served."
+        ),
     )
     parser.add_argument(
         "--separators",
         default=OutputConfig.separators,
-        help="Separators used in JSON output files.",
+        help=(
+            "Separators used in JSON output files. Not applied for --indent 2. "
+            "Only used if --trim is provided."
+        ),
     )
     parser.add_argument(
         "--trim",
@@ -257,6 +481,14 @@ def get_argument_parser() -> ArgumentParser:
         dest="trim_keys",
         help="Package metadata key to remove. Only used if --trim is provided.",
     )
+    parser.add_argument(
+        "--max-workers",
+        type=positive_int,
+        help=(
+            "Maximum number of concurrent fetches. "
+            "Defaults to one per channel and subdir, but at most 32."
+        ),
+    )
     parser.add_argument(
         "--log-level",
         default="info",
@@ -267,12 +499,12 @@ def get_argument_parser() -> ArgumentParser:
 
 def main(argv: Optional[List[str]] = None) -> None:
     argument_parser = get_argument_parser()
-    log_level, output_config, channels, subdirs = parse_args(argument_parser, argv)
+    log_level, output_config, channels, subdirs, max_workers = parse_args(argument_parser, argv)
     log_handler = StreamHandler()
     log_handler.setLevel(log_level)
     logger.addHandler(log_handler)
     logger.setLevel(log_level)
-    fetch(output_config, channels, subdirs)
+    fetch(output_config, channels, subdirs, max_workers)
 
 
 if __name__ == "__main__":